@@ -6,8 +6,10 @@ Note that the Pistachio dataset must be manually imported into data/raw as pista
 before running this script.
 """
 import os
+import shutil
 import requests
 import tarfile
+import numpy as np
 import pandas as pd
 import tarfile
 from rxn.chemutils.utils import remove_atom_mapping
@@ -36,18 +38,21 @@ def download_uspto(data_dir="data/raw/"):
     if not os.path.isfile(target_path):
         response = requests.get(url, stream=True)
         if response.status_code == 200:
+            # Stream the decoded body to disk in 1 MiB chunks rather than buffering the whole archive
+            response.raw.decode_content = True
             with open(target_path, "wb") as f:
-                f.write(response.raw.read())
+                shutil.copyfileobj(response.raw, f, length=1024*1024)
 
     with tarfile.open(target_path) as f:
         f.extractall(data_dir)
 
 
 def reformat_uspto():
-    """Reformat USPTO dataset from .tsv to .csv."""
-    df = pd.read_csv("data/raw/uspto_public.tsv", sep="\t").rename(columns={"rxnmapper_aam":"rxn_map"})
+    """Reformat USPTO dataset from .tsv to .parquet."""
+    df = pd.read_csv("data/raw/uspto_public.tsv", sep="\t", usecols=lambda col: col != "yield")
+    df = df.rename(columns={"rxnmapper_aam":"rxn_map"})
     df.index.name = "dataset_id"
-    df.drop(columns=["yield"]).to_csv("data/raw/1_uspto.csv")
+    df.to_parquet("data/raw/1_uspto.parquet")
 
 
 def load_pistachio():
@@ -55,7 +60,7 @@ def load_pistachio():
     filename = "./data/raw/pistachio.smi"
     if not os.path.exists(filename):
         raise FileNotFoundError("No file named './data/raw/pistachio.smi' - must be manually imported!")
-    pistachio_full = pd.read_csv(filename, sep="\t", header=None).drop(columns=[2], axis=1)
+    pistachio_full = pd.read_csv(filename, sep="\t", header=None, usecols=[0, 1, 3, 4])
     pistachio_full = pistachio_full.rename(columns={0:"rxn_map", 1:"patent", 3:"rxn_class", 4:"rxn_name"})
     pistachio_full.index.name = "dataset_id"
     return pistachio_full
@@ -75,38 +80,40 @@ def size_filter(rxn):
     return (len(rxn)>512)
 
 
-def remap(rxns):
-    """Remaps a list of reactions using RXNMapper."""
-    def batch(iterable, n=1):
-        l = len(iterable)
-        for ndx in range(0, l, n):
-            yield iterable[ndx:min(ndx + n, l)]
-
+def remap(rxns, batch_size=128):
+    """Remaps a list of reactions using RXNMapper. Reactions are sorted by length
+    and batched to minimise padding; failing batches are split in half until the
+    problematic reactions are isolated."""
     rxn_mapper = RXNMapper()
-    results = []
-    batch_size = 32
-    number_batches = (len(rxns) - 1) // batch_size + 1
-    for chunk in tqdm(batch(rxns, batch_size), total=number_batches):
+
+    def map_chunk(chunk):
         try:
             result = rxn_mapper.get_attention_guided_atom_maps(chunk)
-            result = [x["mapped_rxn"] for x in result]
-            results += result
+            return [x["mapped_rxn"] for x in result]
         except:
-            # Batched RXNMapper function cannot handle errors 
-            for rxn in chunk:
-                try:
-                    result = rxn_mapper.get_attention_guided_atom_maps([rxn])
-                except:
-                    result = [{"mapped_rxn": ">>"}]
-                results.append(result[0]["mapped_rxn"])
+            # Batched RXNMapper function cannot handle errors
+            if len(chunk) == 1:
+                return [">>"]
+            mid = len(chunk) // 2
+            return map_chunk(chunk[:mid]) + map_chunk(chunk[mid:])
+
+    order = np.argsort([len(rxn) for rxn in rxns], kind="stable")
+    results = [None] * len(rxns)
+    number_batches = (len(rxns) - 1) // batch_size + 1
+    for start in tqdm(range(0, len(rxns), batch_size), total=number_batches):
+        idx = order[start:start + batch_size]
+        mapped = map_chunk([rxns[i] for i in idx])
+        # Restore original ordering
+        for i, rxn in zip(idx, mapped):
+            results[i] = rxn
     return results
-                
+
 
 def main(args):
     # Initialising USPTO
     download_uspto()
     reformat_uspto()
-    print("Initalised USPTO dataset at data/raw/1_uspto.csv")
+    print("Initalised USPTO dataset at data/raw/1_uspto.parquet")
     
     if not args["uspto_only"]:
         # Initialising Pistachio
@@ -119,8 +126,8 @@ def main(args):
         pistachio_rxns = list(pistachio_filtered["rxn_map"])
         pistachio_filtered["rxn_map"] = remap(pistachio_rxns)
         
-        pistachio_filtered.to_csv("./data/raw/1_pistachio.csv")
-        print("Initalised Pistachio dataset at data/raw/1_pistachio.csv")
+        pistachio_filtered.to_parquet("./data/raw/1_pistachio.parquet")
+        print("Initalised Pistachio dataset at data/raw/1_pistachio.parquet")
 
 
 if __name__ == '__main__':
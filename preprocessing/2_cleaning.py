@@ -8,25 +8,21 @@ import re
 from rdkit import Chem
 from rdkit.Chem.rdChemReactions import ReactionFromSmarts, ReactionToSmiles
 from rdkit.Chem import Draw
-from rxn.chemutils.reaction_equation import (
-    canonicalize_compounds,
-    sort_compounds,
-    cleanup_compounds
-)
-from rxn.chemutils.reaction_smiles import (
-    ReactionFormat,
-    parse_extended_reaction_smiles,
-    to_reaction_smiles,
-)
-from pandarallel import pandarallel
+from rxn.chemutils.conversion import canonicalize_smiles
+from rxn.chemutils.utils import remove_atom_mapping
+from joblib import Parallel, delayed
+from tqdm import tqdm
 from rdkit.Chem.rdMolDescriptors import CalcNumHeavyAtoms
 import argparse
 
-pandarallel.initialize(progress_bar=True, nb_workers=4)
+MAP_NUM_RE = re.compile(r'\:([0-9]+)\]')
+FRAG_STAR_RE = re.compile(r'\[\d+\*\]')
 
 
 def untangle_tildes(rxn_map):
     """Untangles molecules with coordinate bonds ~ in reaction maps"""
+    if "~" not in rxn_map:
+        return rxn_map
     rxn = rxn_map.split(">")
     new_rxn = []
     for side in rxn:
@@ -42,7 +38,7 @@ def untangle_tildes(rxn_map):
                             tilde_list.append(b.GetIdx())
                     mols = Chem.FragmentOnBonds(mols, tilde_list)
                     smiles = Chem.MolToSmiles(mols)
-                    smiles = re.sub(r'\[\d+\*\]', '', smiles).replace("~","").replace("*","").replace("()","")
+                    smiles = FRAG_STAR_RE.sub('', smiles).replace("~","").replace("*","").replace("()","")
                     #smiles = smiles.replace("~",".").split(".")
                     #smiles = ".".join([m for m in smiles if "*" not in m])
                 except:
@@ -71,13 +67,12 @@ def remove_fragment_info(rxn_map):
     return rxn_map.split(" ")[0]
 
 
-def remove_reagents(rxn_map):
-    reactants = rxn_map.split(">>")[0].split(".")
-    product = rxn_map.split(">>")[1]
-    product_maps = set(re.findall('\:([0-9]+)\]', product))
+def remove_reagents(reactants, product):
+    """Removes reactants which do not contribute mapped atoms to the product."""
+    product_maps = set(MAP_NUM_RE.findall(product))
     
     new_reactants = []
-    for smiles in reactants:
+    for smiles in reactants.split("."):
         mol = Chem.MolFromSmiles(smiles)
         if mol is None:
             continue
@@ -90,76 +85,84 @@ def remove_reagents(rxn_map):
                     a.ClearProp('molAtomMapNumber')
         if used:
             new_reactants.append(Chem.MolToSmiles(mol, True))
-    new_rxn_map = ".".join(new_reactants) + ">>" + product
-    return new_rxn_map
+    return ".".join(new_reactants)
 
 
-def reactant_count_filter(rxn_map):
-    reactants = rxn_map.split(">>")[0].split(".")
-    count = len(reactants)
+def reactant_count_filter(reactants):
+    count = len(reactants.split("."))
     if count < 5 and count >= 1:
-        return rxn_map
+        return reactants
     else:
         return "Error: too many reactants"
 
 
-def multiproduct_fixer(rxn_map):
-    products = rxn_map.split(">>")[1].split(".")
+def multiproduct_fixer(product):
+    """Removes side products with 5 or fewer heavy atoms. Returns the
+    product with its parsed molecule, which is reused by later filters
+    to avoid parsing it again."""
+    products = product.split(".")
     if len(products) > 1:
         prod_mols = [Chem.MolFromSmiles(prod) for prod in products]
         try:
             prod_atoms = [CalcNumHeavyAtoms(mol) for mol in prod_mols]
         except:
-            return "Error: invalid product"
+            return "Error: invalid product", None
         prod_bools = [atoms > 5 for atoms in prod_atoms]
-        new_prods = [products[i] for i, b in enumerate(prod_bools) if b]
+        new_prods = [i for i, b in enumerate(prod_bools) if b]
         if len(new_prods) == 1:
-            new_rxn_map = rxn_map.split(">>")[0] + ">>" + new_prods[0]
-            return new_rxn_map
+            return products[new_prods[0]], prod_mols[new_prods[0]]
         else:
-            return "Error: too many products"
+            return "Error: too many products", None
     else:
-        if Chem.MolFromSmiles(products[0]):
-            return rxn_map
+        prod_mol = Chem.MolFromSmiles(products[0])
+        if prod_mol:
+            return product, prod_mol
         else:
-            return "Error: product smiles error"
+            return "Error: product smiles error", None
 
 
-def no_carbon(rxn_map):
+def no_carbon(product, prod_mol):
     """Tags inorganic products."""
-    prod = rxn_map.split(">>")[1]
-    mol = Chem.MolFromSmiles(prod)
-    if mol.HasSubstructMatch(Chem.MolFromSmarts("[#6]")):
-        return rxn_map
+    if any(a.GetAtomicNum() == 6 for a in prod_mol.GetAtoms()):
+        return product
     else:
         return "Error: no organic product"
     
     
-def remove_stereoalchemy(rxn):
+def remove_stereoalchemy(reactants, product, prod_mol):
     """Removes product stereochemistry if no stereochemistry
     is present in the reactants."""
-    r = rxn.split(">>")[0]
-    p = rxn.split(">>")[1]
-    
-    if "@" in p:
-        if "@" not in r:
+    if "@" in product:
+        if "@" not in reactants:
             # Remove chiral centers from product
-            p_mol = Chem.MolFromSmiles(p)
-            Chem.RemoveStereochemistry(p_mol)
-            new_p = Chem.MolToSmiles(p_mol)
-            return rxn.replace(p, new_p)
-    return rxn
+            Chem.RemoveStereochemistry(prod_mol)
+            return Chem.MolToSmiles(prod_mol)
+    return product
 
 
-def product_in_reactants(rxn_map):
-    product = rxn_map.split(">>")[1]
-    reactants = rxn_map.split(">>")[0].split(".")
-    if product in reactants:
+def product_in_reactants(reactants, product):
+    if product in reactants.split("."):
         return "Error: product in reactants"
     else:
-        return rxn_map
+        return product
     
 
+def canonicalise_groups(rxn_map):
+    """Canonicalises and sorts the compounds in each group of a reaction
+    SMILES without fragment information. Equivalent to the rxn.chemutils
+    parse/canonicalise/sort/write round trip, without building the
+    intermediate reaction equation.
+
+    Fragment info has already been stripped by remove_fragment_info, and
+    only reactions with exactly two ">" reach this point, so plain
+    splitting on ">" is enough."""
+    groups = rxn_map.split(">")
+    return ">".join(
+        ".".join(sorted(canonicalize_smiles(smiles) for smiles in group.split(".") if smiles))
+        for group in groups
+    )
+
+
 def canonicalise(rxn_map):
     """Canonicalise reaction CXSMILES. Returns Invalid SMILES if
     SMILES does not contain 2-10 reactants and 1 product. Mixes
@@ -172,14 +175,7 @@ def canonicalise(rxn_map):
         str: Canonicalised reaction SMILES
     """
     try:
-        # Show fragment interactions with ~
-        rxn_type = ReactionFormat.STANDARD_WITH_TILDE
-        # Parse CXSMILES
-        reacteq = parse_extended_reaction_smiles(rxn_map, remove_atom_maps=False)
-        # Canonicalise and sort compounds
-        std_rxn = sort_compounds(canonicalize_compounds(reacteq))
-        # Convert to SMILES
-        new_rxn_map = to_reaction_smiles(std_rxn, rxn_type)
+        new_rxn_map = canonicalise_groups(rxn_map)
         # Check validity with RDKit
         try:
             _ = ReactionFromSmarts(new_rxn_map)
@@ -192,15 +188,7 @@ def canonicalise(rxn_map):
 
 def remove_mapping(rxn_map):
     try:
-        # Show fragment interactions with ~
-        rxn_type = ReactionFormat.STANDARD_WITH_TILDE
-        # Parse CXSMILES
-        reacteq = parse_extended_reaction_smiles(rxn_map, remove_atom_maps=True)
-        # Canonicalise and sort compounds
-        reacteq = cleanup_compounds(reacteq)
-        std_rxn = sort_compounds(canonicalize_compounds(reacteq))
-        # Convert to SMILES
-        rxn = to_reaction_smiles(std_rxn, rxn_type)
+        rxn = canonicalise_groups(remove_atom_mapping(rxn_map))
         # Check validity with RDKit
         try:
             _ = ReactionFromSmarts(rxn)
@@ -211,87 +199,83 @@ def remove_mapping(rxn_map):
         return "Error: mapping"
 
 
-def size_filter(rxn):
-    """Tags reactions longer than 512 tokens."""
-    return (len(rxn)>512)
-    
-    
-def clean_dataset(dataset_name):
-    df = pd.read_csv(f"data/raw/1_{dataset_name}.csv", index_col="dataset_id")
-
-    print("Full dataset size: ", len(df))
-
-    df = df[df["rxn_map"].str.count(">")==2]
-    df = df.drop_duplicates("rxn_map")
-    print("Rows after removing duplicates: ", len(df))
+def clean_row(rxn_map):
+    """Applies all cleaning steps to a single reaction map, stopping at the
+    first step that tags the reaction with an error.
 
-    print("Untangling and removing tildes...")
-    df["rxn_map"] = df["rxn_map"].parallel_apply(untangle_tildes)
-    df = df.drop_duplicates("rxn_map")
-    print("Rows after untangling: ", len(df))
-    
-    print("Joining reactants and reagents...")
-    df["rxn_map"] = df["rxn_map"].parallel_apply(join_reactants_reagents)
-    df = df.drop_duplicates("rxn_map")
-    print("Rows after joining reactants and reagents: ", len(df))
+    Args:
+        rxn_map (str): Atom-mapped reaction CXSMILES
 
-    print("Remove extra info...")
-    df["rxn_map"] = df["rxn_map"].parallel_apply(remove_fragment_info)
-    df = df.drop_duplicates("rxn_map")
-    print("Rows after removing fragment info: ", len(df))
+    Returns:
+        tuple: Cleaned atom-mapped reaction, canonical unmapped reaction, and
+            error message (None unless a step failed)
+    """
+    rxn_map = untangle_tildes(rxn_map)
+    rxn_map = join_reactants_reagents(rxn_map)
+    rxn_map = remove_fragment_info(rxn_map)
+    # Split once and filter the reactants and product separately
+    reactants, _, product = rxn_map.partition(">>")
+    reactants = remove_reagents(reactants, product)
+    reactants = reactant_count_filter(reactants)
+    if reactants.startswith("Error"):
+        return None, None, reactants
+    # Parse the product once and share it between the product filters
+    product, prod_mol = multiproduct_fixer(product)
+    if product.startswith("Error"):
+        return None, None, product
+    product = no_carbon(product, prod_mol)
+    if product.startswith("Error"):
+        return None, None, product
+    product = remove_stereoalchemy(reactants, product, prod_mol)
+    product = product_in_reactants(reactants, product)
+    if product.startswith("Error"):
+        return None, None, product
+    rxn_map = reactants + ">>" + product
+    rxn_map = canonicalise(rxn_map)
+    if rxn_map.startswith("Error"):
+        return None, None, rxn_map
+    canonic_rxn = remove_mapping(rxn_map)
+    if canonic_rxn.startswith("Error"):
+        return None, None, canonic_rxn
+    return rxn_map, canonic_rxn, None
+
+
+def maybe_parallel_map(fn, items, threshold=5000):
+    """Maps fn over items, only starting worker processes when there are
+    enough items to outweigh the cost of the pool."""
+    if len(items) <= threshold:
+        return [fn(item) for item in tqdm(items)]
+    return Parallel(n_jobs=-1, batch_size=256)(delayed(fn)(item) for item in tqdm(items))
 
-    print("Removing reagents")
-    df["rxn_map"] = df["rxn_map"].parallel_apply(remove_reagents)
-    df = df.drop_duplicates("rxn_map")
-    print("Rows after removing reagents: ", len(df))
 
-    print("Removing reactions with >4 reactants")
-    df["rxn_map"] = df["rxn_map"].parallel_apply(reactant_count_filter)
-    df = df[~df["rxn_map"].str.contains("Error")]
-    print("Rows after removing reactions with >4 reactants: ", len(df))
-    
-    print("Removing multi-product reactions and side products...")
-    df["rxn_map"] = df["rxn_map"].parallel_apply(multiproduct_fixer)
-    df = df[~df["rxn_map"].str.contains("Error")]
-    print("Rows after removing multi-product reactions: ", len(df))
-
-    print("Removing inorganic reactions...")
-    df["rxn_map"] = df["rxn_map"].parallel_apply(no_carbon)
-    df = df[~df["rxn_map"].str.contains("Error")]
-    df = df.drop_duplicates("rxn_map")
-    print("Rows after removing inorganic reactions: ", len(df))
+def clean_dataset(dataset_name):
+    df = pd.read_parquet(f"data/raw/1_{dataset_name}.parquet").astype({"rxn_map": "string[pyarrow]"})
 
-    print("Removing stereoalchemy...")
-    df["rxn_map"] = df["rxn_map"].parallel_apply(remove_stereoalchemy)
-    df = df.drop_duplicates("rxn_map")
-    print("Rows after removing stereoalchemy: ", len(df))
+    print("Full dataset size: ", len(df))
 
-    print("Removing reactions with product listed as a reactant...")
-    df["rxn_map"] = df["rxn_map"].parallel_apply(product_in_reactants)
-    df = df[~df["rxn_map"].str.contains("Error")]
+    df = df[df["rxn_map"].str.count(">")==2]
     df = df.drop_duplicates("rxn_map")
-    print("Rows after removing product in reactant reactions: ", len(df))
+    print("Rows after removing duplicates: ", len(df))
 
-    print("Canonicalising...")
-    df["rxn_map"] = df["rxn_map"].parallel_apply(canonicalise)
-    df = df[~df["rxn_map"].str.contains("Error")]
-    print("Rows after canonicalising: ", len(df))
+    print("Cleaning reactions...")
+    cleaned = maybe_parallel_map(clean_row, df["rxn_map"].to_numpy())
+    cleaned = pd.DataFrame(cleaned, index=df.index, columns=["rxn_map", "canonic_rxn", "error"])
+    errors = cleaned["error"].notna()
+    print("Reactions removed per step:")
+    print(cleaned.loc[errors, "error"].value_counts().to_string())
+    df = df[~errors].assign(rxn_map=cleaned["rxn_map"], canonic_rxn=cleaned["canonic_rxn"])
+    print("Rows after cleaning: ", len(df))
 
-    print("Removing atom mapping...")
-    df["canonic_rxn"] = df["rxn_map"].parallel_apply(remove_mapping)
-    df = df[~df["canonic_rxn"].str.contains("Error")]
-    print("Rows after removing atom mapping: ", len(df))
-    
     print("Removing extra long reactions...")
-    df = df[~df["canonic_rxn"].parallel_apply(size_filter)]
+    df = df[df["canonic_rxn"].str.len() <= 512]
     print("Rows after removing extra long reactions: ", len(df))
-    
+
     print("Removing duplicates...")
     df = df.drop_duplicates("canonic_rxn")
     print("Rows after removing duplicates: ", len(df))
 
-    df.to_csv(f"./data/raw/2_{dataset_name}.csv")
-    print(f"Saved to ./data/raw/2_{dataset_name}.csv")
+    df.to_parquet(f"./data/raw/2_{dataset_name}.parquet")
+    print(f"Saved to ./data/raw/2_{dataset_name}.parquet")
     
 
 def main(args):
@@ -11,13 +11,13 @@ from LocalTemplate.extract_from_train_data import build_template_extractor, extr
 def extract_localtemplates(dataset_name, args):
     extractor = build_template_extractor(args)
     
-    df = pd.read_csv(f"./data/raw/2_{dataset_name}.csv")
-    rxns = df['rxn_map'].tolist()
+    df = pd.read_parquet(f"./data/raw/2_{dataset_name}.parquet")
+    template_infos, template_labels = extract_templates(df['rxn_map'], args, extractor)
     
-    template_infos, template_labels = extract_templates(rxns, args, extractor)
-    
-    df['template'] = template_labels
-    print(f"Saved LocalTemplates to ./data/raw/2_{dataset_name}.csv")
+    # Failed extractions are labelled "NaN"; store them as missing values
+    df['template'] = [None if label == "NaN" else label for label in template_labels]
+    df.to_parquet(f"./data/raw/2_{dataset_name}.parquet")
+    print(f"Saved LocalTemplates to ./data/raw/2_{dataset_name}.parquet")
     
     template_infos.to_csv(f"./data/raw/{dataset_name}_template_info.csv")
     print(f"Saved template infos to ./data/raw/2_{dataset_name}_template_info.csv")
@@ -7,17 +7,17 @@ import os
 import argparse
 
 def load_df(dataset_name):
-    df = pd.read_csv(f"data/raw/2_{dataset_name}.csv", index_col="dataset_id")
+    df = pd.read_parquet(f"data/raw/2_{dataset_name}.parquet")
     if 'template' not in df.columns:
-        raise FileNotFoundError("No template column found in csv. Must be extracted via LocalTemplate.")
+        raise FileNotFoundError("No template column found in parquet. Must be extracted via LocalTemplate.")
     return df
 
 
 def filter_templates(df, threshold=5):
     print(len(df))
-    g = df.groupby('template')
-    filtered_df = g.filter(lambda x: len(x) > threshold)
-    print(filtered_df["template"].value_counts())
+    counts = df["template"].value_counts()
+    keep = counts[counts > threshold].index
+    filtered_df = df[df["template"].isin(keep)]
     print(len(filtered_df))
     return filtered_df
 
@@ -26,8 +26,8 @@ def save_df(df, dataset_name):
     data_dir = f"data/processed/{dataset_name}_retro"
     if not os.path.exists(data_dir):
         os.makedirs(data_dir)
-    df.to_csv(f"{data_dir}/{dataset_name}_retro.csv")
-    print(f"Saved to {data_dir}/{dataset_name}_retro.csv")
+    df.to_parquet(f"{data_dir}/{dataset_name}_retro.parquet")
+    print(f"Saved to {data_dir}/{dataset_name}_retro.parquet")
 
 
 def filter_df(dataset_name, threshold=5):
@@ -11,11 +11,13 @@ Splits Pistachio by template:
     ID test: contains 10k reactions with templates also present in USPTO.
     OOD test: contains 10k reactions with templates not present in USPTO.
 """
+import numpy as np
 import pandas as pd
 import os
 import argparse
 
 SET_NAMES = ["train","val","test"]
+STRING_COLUMNS = {"canonic_rxn": "string[pyarrow]", "template": "string[pyarrow]"}
 
 def full_dataset_product_split(data, frac):
     """
@@ -41,24 +43,13 @@ def full_dataset_product_split(data, frac):
     counts = groups.values
     products = groups.index.values
 
-    counter = 0
-    test_products = []
-    val_products = []
-
-    # Append products in list until having a number of reactions > tot
-    test_on = True
-    for i, times in enumerate(counts):
-        if test_on:
-            test_products.append(products[i])
-            counter += times
-            if counter > tot:
-                test_on = False
-                counter = 0
-        else:
-            val_products.append(products[i])
-            counter += times
-            if counter > tot:
-                break
+    # Take products until the cumulative number of reactions exceeds tot,
+    # first for the test set and then for the val set
+    cum = np.cumsum(counts)
+    test_cut = min(np.searchsorted(cum, tot, side="right") + 1, len(cum))
+    val_cut = min(np.searchsorted(cum, cum[test_cut-1] + tot, side="right") + 1, len(cum))
+    test_products = products[:test_cut]
+    val_products = products[test_cut:val_cut]
 
     # Create boolean array to select test reactions
     test_mask = data["products"].isin(test_products)
@@ -101,7 +92,7 @@ def full_split(data):
     Full dataset split, keeping all reactions with equal products in
     the same split. Splits into 90% train, 5% val, 5% test.
     """
-    data["products"] = data["canonic_rxn"].apply(lambda x: x.split(">>")[1])
+    data["products"] = data["canonic_rxn"].str.split(">>", n=1).str[1]
     sets = full_dataset_product_split(data, 0.05)
     save_sets(sets, "full")
     return sets
@@ -121,7 +112,9 @@ def broad_template_split(sets):
     # Create splits sequentially to ensure same sampling
     for i in range(3):
         sets[0] = sets[0].groupby("template").sample(frac=fracs[i+1]/fracs[i], random_state=42)
-        sets[0] = pd.concat([sets[0], must_train]).drop_duplicates()
+        # Add back retained examples by index rather than deduplicating every column
+        missing = must_train[~must_train.index.isin(sets[0].index)]
+        sets[0] = pd.concat([sets[0], missing])
         save_sets(sets, "broad", str(fracs[i+1]))
 
 
@@ -134,18 +127,14 @@ def narrow_template_split(sets):
     groups = sets[0].groupby("template").size().sample(frac=1.0, random_state=40)
     counts = groups.values
     templates = groups.index.values
+    cum = np.cumsum(counts)
     for frac in fracs:
         # Number of reactions desired in the train set
         tot = round(len(sets[0]) * frac/90)
 
-        counter = 0
-        selected_templates = []
-        # Append templates in list until having a number of reactions > tot
-        for i, times in enumerate(counts):
-            selected_templates.append(templates[i])
-            counter += times
-            if counter > tot:
-                break
+        # Take templates until the cumulative number of reactions exceeds tot
+        cut = min(np.searchsorted(cum, tot, side="right") + 1, len(cum))
+        selected_templates = templates[:cut]
         
         # Select reactions in all sets according to templates
         new_sets = [x.loc[x["template"].isin(selected_templates)] for x in sets]
@@ -157,8 +146,10 @@ def template_test(df, df_base):
     Splits external dataset (df) by ID and OOD templates with regards to the original
     dataset (df_base), and samples 10k reactions for each test set.
     """
-    df_ood = df[~df["template"].isin(df_base["template"].drop_duplicates())]
-    df_id = df[df["template"].isin(df_base["template"].drop_duplicates())]
+    base_templates = set(df_base["template"].unique())
+    in_base = df["template"].isin(base_templates)
+    df_ood = df[~in_base]
+    df_id = df[in_base]
     
     for split, split_name in zip([df_ood, df_id], ["OOD", "ID"]):
         print("Pistachio", split_name, "reactions:", len(split))
@@ -169,7 +160,7 @@ def template_test(df, df_base):
 
 def main(args):
     # Load USPTO
-    uspto = pd.read_csv("data/processed/uspto_retro/uspto_retro.csv", index_col="dataset_id")
+    uspto = pd.read_parquet("data/processed/uspto_retro/uspto_retro.parquet").astype(STRING_COLUMNS)
     make_dir("data/processed/uspto_retro/splits")
     # USPTO splits
     uspto_sets = full_split(uspto)
@@ -178,7 +169,7 @@ def main(args):
 
     if not args["uspto_only"]:
         # Load Pistachio
-        pistachio = pd.read_csv("data/processed/pistachio_retro/pistachio_retro.csv", index_col="dataset_id")
+        pistachio = pd.read_parquet("data/processed/pistachio_retro/pistachio_retro.parquet").astype(STRING_COLUMNS)
         # Pistachio splits
         template_test(pistachio, uspto)
 
@@ -18,13 +18,18 @@
 # -----------------------------------------------------------------------------
 
 from collections import defaultdict
+from functools import partial
+from multiprocessing import Pool
 import pandas as pd
 import sys, os
+from tqdm import tqdm
 
 from rdkit import RDLogger 
 RDLogger.DisableLog('rdApp.*')
 
 from .template_extractor import extract_from_reaction
+
+_RETRO_AR = frozenset({'A', 'R'})
             
 def build_template_extractor(args):
     setting = {'verbose': False, 'use_stereo': False, 'use_symbol': False, 'max_unmap': 5, 'retro': False, 'remote': True, 'least_atom_num': 2}
@@ -34,88 +39,116 @@ def build_template_extractor(args):
     if args['retro']:
         setting['use_symbol'] = True
     print ('Template extractor setting:', setting)
-    return lambda x: extract_from_reaction(x, setting)
+    return partial(extract_from_reaction, setting=setting)
 
 def get_reaction_template(extractor, rxn, _id = 0):
-    rxn = {'reactants': rxn.split('>>')[0], 'products': rxn.split('>>')[1], '_id': _id}
+    reactants, _, products = rxn.partition('>>')
+    rxn = {'reactants': reactants, 'products': products, '_id': _id}
     result = extractor(rxn)
     return rxn, result
 
+def _code(change):
+    return ''.join(map(str, (change[k] for k in range(1, len(change) + 1))))
+
 def get_full_template(template, H_change, Charge_change, Chiral_change):
-    H_code = ''.join([str(H_change[k+1]) for k in range(len(H_change))])
-    Charge_code = ''.join([str(Charge_change[k+1]) for k in range(len(Charge_change))])
-    Chiral_code = ''.join([str(Chiral_change[k+1]) for k in range(len(Chiral_change))])
+    H_code = _code(H_change)
+    Charge_code = _code(Charge_change)
+    Chiral_code = _code(Chiral_change)
     if Chiral_code == '':
-        return '_'.join([template, H_code, Charge_code])
+        return f'{template}_{H_code}_{Charge_code}'
     else:
-        return '_'.join([template, H_code, Charge_code, Chiral_code])
+        return f'{template}_{H_code}_{Charge_code}_{Chiral_code}'
             
-def extract_templates(rxns, args, extractor):    
-    TemplateEdits = {}
-    TemplateCs = {}
-    TemplateHs = {}
-    TemplateSs = {}
-    TemplateFreq = defaultdict(int)
-    templates_A = defaultdict(int)
-    templates_B = defaultdict(int)
-    template_labels = []
-    
-    for i, reaction in enumerate(rxns):
-        try:
-            rxn, result = get_reaction_template(extractor, reaction, i)
-            if 'reactants' not in result or 'reaction_smarts' not in result.keys():
-                raise Exception("template problem")
-            template = result['reaction_smarts']
-            edits = result['edits']
-            H_change = result['H_change']
-            Charge_change = result['Charge_change']
-            if args['use_stereo']:
-                Chiral_change = result['Chiral_change']
-            else:
-                Chiral_change = {}
-            template_H = get_full_template(template, H_change, Charge_change, Chiral_change)
-            if template_H not in TemplateHs.keys():
-                TemplateEdits[template_H] = {edit_type: edits[edit_type][2] for edit_type in edits}
-                TemplateHs[template_H] = H_change
-                TemplateCs[template_H] = Charge_change
-                TemplateSs[template_H] = Chiral_change
-            template_labels.append(template_H)
+class TemplateRecord:
+    __slots__ = ('edits', 'H', 'C', 'S', 'freq')
 
-            TemplateFreq[template_H] += 1
+    def __init__(self, edits, H, C, S, freq=0):
+        self.edits = edits
+        self.H = H
+        self.C = C
+        self.S = S
+        self.freq = freq
 
-            if args['retro']:
-                for edit_type, bonds in edits.items():
-                    bonds = bonds[0]
-                    if len(bonds) > 0:
-                        if edit_type in ['A', 'R']:
-                            templates_A[template_H] += 1
-                        else:
-                            templates_B[template_H] += 1
+def _init_worker(extractor, use_stereo):
+    global _extractor, _use_stereo
+    # Older RDKit builds do not always route every sublogger through 'rdApp.*'
+    for log in ('rdApp.*', 'rdApp.error', 'rdApp.warning'):
+        RDLogger.DisableLog(log)
+    _extractor = extractor
+    _use_stereo = use_stereo
 
-            else:
-                for edit_type, bonds in edits.items():
-                    bonds = bonds[0]
-                    if len(bonds) > 0:
-                        if edit_type != 'A':
-                            templates_A['%s_%s' % (template_H, edit_type)] += 1
-                        else:
-                            templates_B['%s_%s' % (template_H, edit_type)] += 1
-                
-        except KeyboardInterrupt:
-            print('Interrupted')
-            try:
-                sys.exit(0)
-            except SystemExit:
-                os._exit(0)
-        except Exception as e:
-            template_labels.append("NaN")
+def _extract_one(item):
+    i, reaction = item
+    try:
+        rxn, result = get_reaction_template(_extractor, reaction, i)
+        # Extractor returns None or an incomplete result for template problems
+        if result is None or 'reactants' not in result or 'reaction_smarts' not in result:
+            return i, None
+        template = result['reaction_smarts']
+        edits = result['edits']
+        H_change = result['H_change']
+        Charge_change = result['Charge_change']
+        if _use_stereo:
+            Chiral_change = result['Chiral_change']
+        else:
+            Chiral_change = {}
+        template_H = get_full_template(template, H_change, Charge_change, Chiral_change)
+        return i, (template_H, edits, H_change, Charge_change, Chiral_change)
+    except Exception as e:
+        return i, None
             
-        if i % 10000 == 0 and i > 0:
-            print ('\r i = %s, # of template: %s, # of atom template: %s, # of bond template: %s' % (i, len(TemplateFreq), len(templates_A), len(templates_B)), end='', flush=True)
+def extract_templates(rxns, args, extractor):
+    """Extracts templates for a sequence (list or Series) of atom-mapped reaction SMILES."""
+    TemplateInfo = {}
+    templates_A = defaultdict(int)
+    templates_B = defaultdict(int)
+    template_labels = [None] * len(rxns)
+    
+    use_stereo = args['use_stereo']
+    if args['retro']:
+        def bump(edit_type, template_H):
+            (templates_A if edit_type in _RETRO_AR else templates_B)[template_H] += 1
+    else:
+        def bump(edit_type, template_H):
+            (templates_B if edit_type == 'A' else templates_A)[(template_H, edit_type)] += 1
+    try:
+        with Pool(processes=os.cpu_count(), initializer=_init_worker, initargs=(extractor, use_stereo)) as pool:
+            results = pool.imap(_extract_one, enumerate(rxns), chunksize=256)
+            for i, result in tqdm(results, total=len(rxns), mininterval=1.0, smoothing=0.1):
+                if result is None:
+                    template_labels[i] = "NaN"
+                    continue
+                template_H, edits, H_change, Charge_change, Chiral_change = result
+                # Results are unpickled as new strings; share one object per template
+                template_H = sys.intern(template_H)
+                record = TemplateInfo.get(template_H)
+                if record is None:
+                    edit_site = {edit_type: edits[edit_type][2] for edit_type in edits}
+                    record = TemplateInfo[template_H] = TemplateRecord(edit_site, H_change, Charge_change, Chiral_change)
+                record.freq += 1
+                template_labels[i] = template_H
+                for edit_type, bonds in edits.items():
+                    if bonds[0]:
+                        bump(edit_type, template_H)
+    except KeyboardInterrupt:
+        print('Interrupted')
+        try:
+            sys.exit(0)
+        except SystemExit:
+            os._exit(0)
         
-    print ('\n total # of template: %s' %  len(TemplateFreq))
+    print ('total # of template: %s, # of atom template: %s, # of bond template: %s' % (len(TemplateInfo), len(templates_A), len(templates_B)))
         
-    template_infos = pd.DataFrame({'Template': k, 'edit_site':TemplateEdits[k], 'change_H': TemplateHs[k], 'change_C': TemplateCs[k], 'change_S': TemplateSs[k], 'Frequency': TemplateFreq[k]} for k in TemplateHs.keys())
+    # The edit and change columns stay as dicts: their reprs in template_info.csv
+    # are parsed back into dicts by the downstream LocalRetro loaders
+    records = TemplateInfo.values()
+    template_infos = pd.DataFrame({
+        'Template': pd.array(list(TemplateInfo), dtype='string[pyarrow]'),
+        'edit_site': [r.edits for r in records],
+        'change_H': [r.H for r in records],
+        'change_C': [r.C for r in records],
+        'change_S': [r.S for r in records],
+        'Frequency': pd.array([r.freq for r in records], dtype='int64[pyarrow]')})
     
     return template_infos, template_labels
     
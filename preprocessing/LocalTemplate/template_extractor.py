@@ -7,6 +7,9 @@
 # This version has been archived from February 2024 and redistributed by 
 # Sara Tanovic on 10/11/2025, to preserve reproducibility for academic research.
 # 
+# Modified on 15/10/2026: split_reagents parses each product SMILES once
+# instead of twice. Extracted templates are unchanged.
+# 
 # You may not use this file except in compliance with the License.
 # A copy of the License is provided in the LICENSE file in this repository.
 # 
@@ -528,8 +531,9 @@ def extend_atom_tag(reactant, max_num):
     
 def split_reagents(reaction):
     rs, ps = replace_deuterated(reaction['reactants']).split('.'), replace_deuterated(reaction['products']).split('.')
-    least_atom_n = min([max([Chem.MolFromSmiles(smiles).GetNumAtoms() for smiles in ps if smiles not in rs]), LEAST_ATOM_NUM])
-    ps = [smiles for smiles in ps if Chem.MolFromSmiles(smiles).GetNumAtoms() >= least_atom_n]
+    n_atoms = {smiles: Chem.MolFromSmiles(smiles).GetNumAtoms() for smiles in ps}
+    least_atom_n = min([max([n_atoms[smiles] for smiles in ps if smiles not in rs]), LEAST_ATOM_NUM])
+    ps = [smiles for smiles in ps if n_atoms[smiles] >= least_atom_n]
     reagents = [smiles for smiles in rs if smiles in ps]
     return [r for r in rs if r not in reagents], [p for p in ps if p not in reagents], reagents                                                     
                                                                                         